@@ -1,30 +1,23 @@
 import bpy
 import bpy_extras
+import gc
+import os
+import sys
 import struct
-from bpy.props import StringProperty, BoolProperty, EnumProperty
+import importlib
+import multiprocessing
+import multiprocessing.spawn
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from bpy.props import StringProperty, BoolProperty, EnumProperty, IntProperty
 from mathutils import Vector, Quaternion, Matrix
-from io import BytesIO
-from .lmt.Lmt import LMT, AnimationBlock
+from .lmt.Lmt import LMT, AnimationBlock, BonePath, Events
+from .lmt.Keys import decode_animation, decoded_size, decode_lmt_animations, unit_quaternions, reset_peak_memory, peak_memory
 
 bl_info = {"name": "LMT Importer", "category": "Animation"}
 
-def lerp3(value, bounds):
-    if (bounds is None):
-        return value
-    value = Vector(value[:])
-    value = Vector(x * y for x, y in zip(value, bounds.mult[0:3]))
-    return Vector(value + Vector(bounds.add[0:3]))
-
-def lerpq(value, bounds):
-    ret = Quaternion()
-    mult = Vector(bounds.mult)
-    add = Vector(bounds.add)
-    ret.x = add.x + value.x * mult.x
-    ret.y = add.y + value.y * mult.y
-    ret.z = add.z + value.z * mult.z
-    ret.w = add.w + value.w * mult.w
-    return ret
-
 def recompose(trs, rot, scl):
     return (
         Matrix.Translation(trs) * rot.to_matrix().to_4x4() 
@@ -33,258 +26,412 @@ def recompose(trs, rot, scl):
         * Matrix.Scale(scl[2],4,(0, 0, 1))
     )
 
-def structread(io, format):
-    return list(struct.unpack(format, io.read(struct.calcsize(format))))
-
-class QuantizedVals:
-    def __init__(self, array, bit_per_elem = 8):
-        self.array = [int(x) for x in array]
-        self.bit_per_elem = bit_per_elem
-        self.total_bits = len(array) * bit_per_elem
-        self.elem_bits = bit_per_elem
-
-    def skipbits(self, bitcount):
-        while bitcount > 0:
-            count = min(bitcount, self.elem_bits)
-            self.elem_bits -= count
-            bitcount -= count
-            if self.elem_bits == 0:
-                self.array = self.array[1:]
-                self.elem_bits = self.bit_per_elem
-            else:
-                self.array[0] = self.array[0] >> count
-        self.total_bits -= bitcount
-
-    def loadbits(self, bitcount, scale = 0):
-        val = 0
-        bits_left = bitcount
-        current_elem = 0
-        current_bitcount = min(self.elem_bits, bits_left)
-        while bits_left > 0:
-            val = val << current_bitcount
-            val = val | (self.array[current_elem] & ((1 << current_bitcount) - 1))
-            bits_left -= current_bitcount
-            current_elem += 1
-            current_bitcount = min(self.bit_per_elem, bits_left)
-            
-
-        maxval = ((1 << bitcount) - 1)
-        if scale == 1:
-            val = val / maxval
-        elif scale == -1:
-            if val > (maxval >> 1):
-                val -= maxval
-            val = val / (maxval >> 1)
-        return val
-
-    def takebits(self, bitcount, scale = 0):
-        ret = self.loadbits(bitcount, scale)
-        self.skipbits(bitcount)
-        return ret
-
-class Key:
-    #if type == 1:
-    def baseFloatVectorKey(self, io, bounds):
-        self.value = Vector(structread(io, "fff"))
-        self.frame = 1
-    #elif type == 2 or type == 3 or type == 9:
-    def floatVectorKey(self, io, bounds):
-        self.value = Vector(structread(io, "fff"))
-        self.frame = structread(io, "I")[0]
-    #elif type == 4:
-    def shortVectorKey(self, io, bounds):
-        self.value = Vector((x / 65535) for x in structread(io, "HHH"))
-        self.frame = structread(io, "H")[0]
-        self.value = lerp3(self.value, bounds)
-
-    #elif type == 5:
-    def byteVectorKey(self, io, bounds):
-        self.value = Vector((x / 255) for x in structread(io, "BBB"))
-        self.frame = structread(io, "B")[0]
-        self.value = lerp3(self.value, bounds)
-
-    #elif type == 6:
-    def bits14QuaternionKey(self, io, bounds):
-        values = QuantizedVals(structread(io, "Q"), 64)
-        self.value = Quaternion((1, 0, 0, 0))
-        self.value.w = values.takebits(14, -1) * 2
-        self.value.z = values.takebits(14, -1) * 2
-        self.value.y = values.takebits(14, -1) * 2
-        self.value.x = values.takebits(14, -1) * 2
-        self.frame = values.takebits(8)
-
-    #elif type == 7:
-    def bits7QuaternionKey(self, io, bounds):
-        values = QuantizedVals(structread(io, "I"), 32)
-        self.value = Quaternion((1, 0, 0, 0))
-        self.value.w = values.takebits(7, 1)
-        self.value.z = values.takebits(7, 1)
-        self.value.y = values.takebits(7, 1)
-        self.value.x = values.takebits(7, 1)
-        self.frame = values.takebits(4)
-        self.value = lerpq(self.value, bounds)
-
-    #elif type == 11:
-    def XWQuaternionKey(self, io, bounds):
-        value = QuantizedVals(structread(io, "I"), 32)
-        self.value = Quaternion((1, 0, 0, 0))
-        if bounds is not None:
-            self.value.x = value.takebits(14, 1)
-            self.value.w = value.takebits(14, 1)
-            self.value = lerpq(self.value, bounds)
-        else:
-            self.value.w = value.takebits(14) / 0xFFF
-            self.value.x = value.takebits(14)
-            if (self.value.x > 0x1fff != 0):
-                self.value.x = -(0x1fff - self.value.x)
-            self.value.x /= 0x8ff
-        self.frame = value.takebits(4)
-    #elif type == 12:
-    def YWQuaternionKey(self, io, bounds):
-        value = QuantizedVals(structread(io, "I"), 32)
-        self.value = Quaternion((1, 0, 0, 0))
-        if bounds is not None:
-            self.value.y = value.takebits(14, 1)
-            self.value.w = value.takebits(14, 1)
-            self.value = lerpq(self.value, bounds)
-        else:
-            self.value.w = value.takebits(14) / 0xFFF
-            self.value.y = value.takebits(14)
-            if (self.value.y > 0x1fff != 0):
-                self.value.y = -(0x1fff - self.value.y)
-            self.value.y /= 0x8ff
-        self.frame = value.takebits(4)
-    #elif type == 13:
-    def ZWQuaternionKey(self, io, bounds):
-        value = QuantizedVals(structread(io, "I"), 32)
-        self.value = Quaternion((1, 0, 0, 0))
-        if bounds is not None:
-            self.value.z = value.takebits(14, 1)
-            self.value.w = value.takebits(14, 1)
-            self.value = lerpq(self.value, bounds)
-        else:
-            self.value.w = value.takebits(14) / 0xFFF
-            self.value.z = value.takebits(14)
-            if (self.value.z > 0x1fff != 0):
-                self.value.z = -(0x1fff - self.value.z)
-            self.value.z /= 0x8ff
-        self.frame = value.takebits(4)
-    #elif type == 14:
-    def bits11QuaternionKey(self, io, bounds):
-        values = QuantizedVals(structread(io, "HHH"), 16)
-        self.value = Quaternion((1, 0, 0, 0))
-        self.value.x = values.takebits(11, 1)
-        self.value.y = values.takebits(11, 1)
-        self.value.z = values.takebits(11, 1)
-        self.value.w = values.takebits(11, 1)
-        self.frame = values.takebits(4)
-        self.value = lerpq(self.value, bounds)
-    #15
-    def bits9QuaternionKey(self, io, bounds):
-        values = QuantizedVals(io.read(5))
-        self.value = Quaternion((1, 0, 0, 0))
-        self.value.x = values.takebits(9, 1)
-        self.value.y = values.takebits(9, 1)
-        self.value.z = values.takebits(9, 1)
-        self.value.w = values.takebits(9, 1)
-        self.frame = values.takebits(4)
-        self.value = lerpq(self.value, bounds)
-    
-    def __init__(self, io, type, bounds):
-        [
-            None,
-            self.baseFloatVectorKey,
-            self.floatVectorKey,
-            self.floatVectorKey,
-            self.shortVectorKey,
-            self.byteVectorKey,
-            self.bits14QuaternionKey,
-            self.bits7QuaternionKey,
-            None,
-            self.floatVectorKey,
-            None,
-            self.XWQuaternionKey,
-            self.YWQuaternionKey,
-            self.ZWQuaternionKey,
-            self.bits11QuaternionKey,
-            self.bits9QuaternionKey
-        ][type](io, bounds)
-
-
-class BaseKey:
-    def __init__(self, ref, usage):
-        if usage == 0 or usage == 3: 
-            self.value = Quaternion([ref[3]] + ref[0:3])
+def fcurve_points(fcurve):
+    co = array('f', [0.0]) * (len(fcurve.keyframe_points) * 2)
+    fcurve.keyframe_points.foreach_get('co', co)
+    return co[0::2], co[1::2]
+
+def sample_channel(fcurves, defaults):
+    points = [fcurve_points(fc) if fc else None for fc in fcurves]
+    keyed = [p for p in points if p]
+    frames = keyed[0][0]
+    if all(p[0] == frames for p in keyed):
+        columns = [list(p[1]) if p else [d] * len(frames) for p, d in zip(points, defaults)]
+    else:
+        # Components keyed on different frames, resample them on the union
+        frames = sorted(set(f for p in keyed for f in p[0]))
+        columns = [[fc.evaluate(f) for f in frames] if fc else [d] * len(frames) for fc, d in zip(fcurves, defaults)]
+    return [int(round(f)) for f in frames], columns
+
+def split_gaps(frames, columns, max_delta):
+    out_frames = frames[:1]
+    out_columns = [c[:1] for c in columns]
+    for i in range(1, len(frames)):
+        start, end = frames[i - 1], frames[i]
+        for frame in range(start + max_delta, end, max_delta):
+            t = (frame - start) / (end - start)
+            out_frames.append(frame)
+            for out, c in zip(out_columns, columns):
+                out.append(c[i - 1] + (c[i] - c[i - 1]) * t)
+        out_frames.append(end)
+        for out, c in zip(out_columns, columns):
+            out.append(c[i])
+    return out_frames, out_columns
+
+def frame_deltas(frames):
+    return [b - a for a, b in zip(frames, frames[1:])] + [0]
+
+def quantize14(value):
+    q = int(round(max(-1.0, min(1.0, value / 2)) * 0x1fff))
+    return q + 0x3fff if q < 0 else q
+
+def encode_vector_keys(frames, columns):
+    #type 2
+    flat = [v for key in zip(*columns, frame_deltas(frames)) for v in key]
+    return struct.pack('fffI' * len(frames), *flat)
+
+def encode_quaternion_keys(frames, columns):
+    #type 6, w z y x then frame from the low bits up
+    frames, columns = split_gaps(frames, columns, 0xff)
+    w, x, y, z = ([quantize14(v) for v in c] for c in columns)
+    packed = [
+        qw | qz << 14 | qy << 28 | qx << 42 | d << 56
+        for qw, qx, qy, qz, d in zip(w, x, y, z, frame_deltas(frames))
+    ]
+    return struct.pack('Q' * len(packed), *packed)
+
+def rotate_quaternions(q, columns):
+    w, x, y, z = columns
+    return [
+        [q.w * bw - q.x * bx - q.y * by - q.z * bz for bw, bx, by, bz in zip(w, x, y, z)],
+        [q.w * bx + q.x * bw + q.y * bz - q.z * by for bw, bx, by, bz in zip(w, x, y, z)],
+        [q.w * by - q.x * bz + q.y * bw + q.z * bx for bw, bx, by, bz in zip(w, x, y, z)],
+        [q.w * bz + q.x * by - q.y * bx + q.z * bw for bw, bx, by, bz in zip(w, x, y, z)],
+    ]
+
+def transform_points(matrix, columns):
+    x, y, z = columns
+    return [
+        [row[0] * px + row[1] * py + row[2] * pz + row[3] for px, py, pz in zip(x, y, z)]
+        for row in matrix[0:3]
+    ]
+
+CHANNELS = {
+    0: ('rotation_quaternion', 4),
+    1: ('location', 3),
+    3: ('rotation_quaternion', 4),
+    4: ('location', 3),
+}
+
+def rest_relative(bone):
+    # Rest matrix of a pose bone relative to its parent, in armature space for parentless bones
+    if bone.parent:
+        return bone.parent.bone.matrix_local.inverted() * bone.bone.matrix_local
+    return bone.bone.matrix_local
+
+def key_fcurves(action, data_path, group, points):
+    # New F-curves get the points copied in bulk, points for curves that already exist are inserted
+    for index, co in points:
+        fcurve = action.fcurves.find(data_path, index)
+        if fcurve is None:
+            fcurve = action.fcurves.new(data_path, index, group)
+            fcurve.keyframe_points.add(len(co) // 2)
+            fcurve.keyframe_points.foreach_set('co', co)
         else:
-            self.value = Vector(ref[0:3])
-        self.frame = 0
-
-class KeyFrameList:
-    def __init__(self, bone_path):
-        key_frame_list = []
-        io = BytesIO(bone_path.buffer)
-        while io.tell() < len(bone_path.buffer):
-            key_frame_list += [Key(io, bone_path.buffer_type, bone_path.bounds)]
-        if not key_frame_list:
-            key_frame_list += [BaseKey(bone_path.reference_frame, bone_path.usage)]
-        self.bone_id = bone_path.bone_id
-        self.usage = bone_path.usage
-        self.keys = key_frame_list
-
-        
+            for frame, value in zip(co[0::2], co[1::2]):
+                fcurve.keyframe_points.insert(frame, value, options={'FAST'})
+        fcurve.update()
+
+class TrackCache(dict):
+    # F-curve points by track signature, emptied when it would grow past budget bytes
+    def __init__(self, budget = 0):
+        super().__init__()
+        self.budget = budget
+        self.size = 0
+
+    @staticmethod
+    def entry_size(signature, points):
+        return len(signature[3]) + sum(co.itemsize * len(co) for _, co in points)
+
+    def __setitem__(self, signature, points):
+        if signature in self:
+            self.size -= self.entry_size(signature, self[signature])
+        size = self.entry_size(signature, points)
+        if self.budget and self.size + size > self.budget:
+            self.clear()
+        super().__setitem__(signature, points)
+        self.size += size
+
+    def clear(self):
+        super().clear()
+        self.size = 0
+
+class WorkerPool:
+    # Decoding is pure Python, so it only overlaps with applying in another process. Workers run the
+    # python bundled with Blender, which can't import bpy: the decoder is imported from the add-on
+    # folder as the top level lmt package so workers never import this module.
+    # The add-on folder on sys.path, the top level lmt modules and the spawn executable are only
+    # changed while the pool is open, close() restores them.
+    def __init__(self, workers):
+        self.keys = None
+        self.pool = None
+        self.addon_dir = os.path.dirname(os.path.abspath(__file__))
+        self.added_path = self.addon_dir not in sys.path
+        self.modules = set(sys.modules)
+        self.executable = multiprocessing.spawn.get_executable()
+        if self.added_path:
+            sys.path.append(self.addon_dir)
+        try:
+            keys = importlib.import_module('lmt.Keys')
+        except ImportError:
+            self.close()
+            return
+        if os.path.dirname(os.path.dirname(os.path.abspath(keys.__file__))) != self.addon_dir:
+            self.close()
+            return
+
+        python = getattr(bpy.app, 'binary_path_python', None) or sys.executable
+        try:
+            context = multiprocessing.get_context('spawn')
+            context.set_executable(python)
+            self.pool = ProcessPoolExecutor(workers, mp_context=context)
+        except TypeError:
+            # No mp_context before Python 3.7
+            multiprocessing.set_executable(python)
+            self.pool = ProcessPoolExecutor(workers)
+        except (OSError, ValueError):
+            self.close()
+            return
+        self.keys = keys
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+        self.keys = None
+        multiprocessing.spawn.set_executable(self.executable)
+        if self.added_path and self.addon_dir in sys.path:
+            sys.path.remove(self.addon_dir)
+        for name in set(sys.modules) - self.modules:
+            if name == 'lmt' or name.startswith('lmt.'):
+                del sys.modules[name]
+
+class AnimationPrefetcher:
+    # Decodes upcoming animations in worker processes while the main thread applies the current one.
+    # At most size batches are in flight. With a budget, decoded batches waiting to be applied count
+    # their size and batches still decoding the size animations decoded so far average, no batch is
+    # submitted that would take them past budget bytes. Without worker processes batches are
+    # decoded in place.
+    def __init__(self, filepath, ids, size, budget = 0, batch = 4):
+        self.filepath = filepath
+        self.batches = [ids[i:i + batch] for i in range(0, len(ids), batch)]
+        self.size = size
+        self.budget = budget
+        self.decoded = 0
+        self.animations = 0
+        # Highest peak memory a worker process reported
+        self.worker_peak = None
+        # One core is left to the main thread, with no core to spare or a single batch nothing can overlap
+        workers = min(size, (os.cpu_count() or 1) - 1)
+        self.workers = WorkerPool(workers) if workers > 0 and len(self.batches) > 1 else None
+        self.keys, self.pool = (self.workers.keys, self.workers.pool) if self.workers else (None, None)
+        self.pending = deque()
+
+    def estimate(self, ids):
+        return len(ids) * self.decoded // self.animations if self.animations else 0
+
+    def held(self):
+        held = 0
+        for ids, future in self.pending:
+            if future.done() and not future.exception():
+                held += sum(decoded_size(key_frames) for _, key_frames in future.result()[0])
+            else:
+                held += self.estimate(ids)
+        return held
+
+    def admits(self, ids):
+        if not self.budget:
+            return True
+        # Nothing to estimate the batch with before the first one is decoded
+        if self.pending and not self.animations:
+            return False
+        return self.held() + self.estimate(ids) <= self.budget
+
+    def __iter__(self):
+        batches = deque(self.batches)
+        while self.pending or batches:
+            while self.pool and batches and len(self.pending) < self.size and self.admits(batches[0]):
+                ids = batches.popleft()
+                self.pending.append((ids, self.pool.submit(self.keys.decode_worker_batch, self.filepath, ids)))
+            if not self.pending:
+                results = decode_lmt_animations(self.filepath, batches.popleft())
+            else:
+                ids, future = self.pending.popleft()
+                try:
+                    results, peak = future.result()
+                    if peak is not None:
+                        self.worker_peak = max(self.worker_peak or 0, peak)
+                except BrokenProcessPool:
+                    # Workers failed to start or died, decode the rest here
+                    if self.pool:
+                        self.pool.shutdown(wait=False)
+                        self.pool = None
+                    results = decode_lmt_animations(self.filepath, ids)
+            self.decoded += sum(decoded_size(key_frames) for _, key_frames in results)
+            self.animations += len(results)
+            while results:
+                yield results.pop(0)
+
+    def close(self):
+        for _, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.pool = None
+        if self.workers:
+            self.workers.close()
+
 class Animation:
-    def __init__(self, animation_block : AnimationBlock, armature_obj):
+    def __init__(self, animation_block : AnimationBlock, armature_obj, key_frames = None):
         self.block = animation_block
-        self.key_frames = [KeyFrameList(b) for b in animation_block.bone_paths]
+        self.key_frames = key_frames if key_frames is not None else decode_animation(animation_block)
 
         self.bone_map  = {-1: armature_obj.pose.bones[0]}
         for bone, edit_bone in zip(armature_obj.pose.bones, armature_obj.data.edit_bones):
             if "boneFunction" in edit_bone:
                 bone["boneFunction"] = edit_bone["boneFunction"]
                 self.bone_map[edit_bone["boneFunction"]] = bone
+
+    def release(self):
+        self.block = None
+        self.key_frames = None
     
-    def apply_animation(self, armature_obj):
+    def apply_animation(self, armature_obj, track_cache = None):
+        # track_cache maps decoded track content to the F-curve points it produced, identical
+        # tracks of later animations copy those points instead of keying again. Only usages 0 and 1
+        # are cached, 3 and 4 depend on the pose earlier tracks left the parent in.
+        action = armature_obj.animation_data.action
         for key_frame_list in self.key_frames:
-            if key_frame_list.bone_id not in self.bone_map:
+            if key_frame_list.bone_id not in self.bone_map or key_frame_list.usage not in CHANNELS:
                 continue
             bone = self.bone_map[key_frame_list.bone_id]
-            frameId = 0
-
-            local_bone_matrix = bone.matrix
-            if bone.parent:
-                local_bone_matrix = armature_obj.convert_space(bone.parent, bone.matrix, 'POSE', 'LOCAL')
-            
-            if key_frame_list.usage == 0:
-                for key in key_frame_list.keys:
-                    trs, rot, scl = local_bone_matrix.decompose()
-                    rot = key.value
-                    nmatrix = recompose(trs, rot, scl)
-                    bone.matrix = armature_obj.convert_space(bone.parent, nmatrix, 'LOCAL', 'POSE')
-                    bone.keyframe_insert('rotation_quaternion', frame=frameId)
-                    frameId += key.frame
-            if key_frame_list.usage == 1:
-                for key in key_frame_list.keys:
-                    trs, rot, scl = local_bone_matrix.decompose()
-                    trs = key.value
-                    nmatrix = recompose(trs, rot, scl)
-                    bone.matrix = armature_obj.convert_space(bone.parent, nmatrix, 'LOCAL', 'POSE')
-                    bone.keyframe_insert('location', frame=frameId)
-                    frameId += key.frame
-            if key_frame_list.usage == 3:
-                for key in key_frame_list.keys:
-                    trs, rot, scl = bone.matrix.decompose()
-                    rot = key.value
-                    bone.matrix = recompose(trs, rot, scl)
-                    bone.keyframe_insert('rotation_quaternion', frame=frameId)
-                    frameId += key.frame
-            if key_frame_list.usage == 4:
-                for key in key_frame_list.keys:
-                    trs, rot, scl = bone.matrix.decompose()
-                    trs = key.value
-                    bone.matrix = recompose(trs, rot, scl)
-                    bone.keyframe_insert('location', frame=frameId)
-                    frameId += key.frame
-        
+            prop, count = CHANNELS[key_frame_list.usage]
+            if key_frame_list.width != count:
+                continue
+            data_path = bone.path_from_id(prop)
+            if key_frame_list.usage in (0, 1):
+                points = track_cache.get(key_frame_list.signature) if track_cache is not None else None
+                if points is None:
+                    # Keys are relative to the parent, the pose channels to the rest pose on top of it
+                    columns = key_frame_list.columns()
+                    rest = rest_relative(bone).inverted()
+                    if key_frame_list.usage == 0:
+                        columns = unit_quaternions(rotate_quaternions(rest.to_quaternion(), columns))
+                    else:
+                        columns = transform_points(rest, columns)
+                    points = key_frame_list.points(columns)
+                    if track_cache is not None:
+                        track_cache[key_frame_list.signature] = points
+                key_fcurves(action, data_path, bone.name, points)
+                # Leave the channel at its last key as keying through the pose did, later tracks read it
+                value = list(getattr(bone, prop))
+                for index, co in points:
+                    value[index] = co[-1]
+                setattr(bone, prop, value)
+                continue
+            self.apply_track(armature_obj, bone, key_frame_list)
+
+    def apply_track(self, armature_obj, bone, key_frame_list):
+        # Armature space tracks, keyed through the pose as they depend on it
+        if key_frame_list.usage == 3:
+            for frameId, value in key_frame_list.keys():
+                trs, rot, scl = bone.matrix.decompose()
+                rot = Quaternion(value)
+                bone.matrix = recompose(trs, rot, scl)
+                bone.keyframe_insert('rotation_quaternion', frame=frameId)
+        if key_frame_list.usage == 4:
+            for frameId, value in key_frame_list.keys():
+                trs, rot, scl = bone.matrix.decompose()
+                trs = Vector(value)
+                bone.matrix = recompose(trs, rot, scl)
+                bone.keyframe_insert('location', frame=frameId)
+
+
+class AnimationExporter:
+    ROTATION_USAGES = (0, 3)
+    LOCATION_USAGES = (1, 4)
+
+    def __init__(self, armature_obj):
+        self.warnings = []
+        self.bone_map = {-1: armature_obj.pose.bones[0]}
+        for bone in armature_obj.pose.bones:
+            if "boneFunction" in bone.bone:
+                self.bone_map[bone.bone["boneFunction"]] = bone
+
+    def channel(self, action, bone, prop, count, defaults):
+        data_path = bone.path_from_id(prop)
+        fcurves = [action.fcurves.find(data_path, i) for i in range(count)]
+        if not any(fcurves):
+            return None
+        return sample_channel(fcurves, defaults)
+
+    def bone_path(self, action, bone_id, usage, template = None):
+        bone = self.bone_map[bone_id]
+        if usage in (3, 4) and bone.parent:
+            # The importer keyed these against the animated pose of the parent, which isn't known here
+            self.warnings += ["%s: kept the armature space track of %s, its bone has a parent" % (action.name, bone.name)]
+            return template
+        if usage in self.ROTATION_USAGES:
+            sampled = self.channel(action, bone, 'rotation_quaternion', 4, (1.0, 0.0, 0.0, 0.0))
+        else:
+            sampled = self.channel(action, bone, 'location', 3, (0.0, 0.0, 0.0))
+        if sampled is None:
+            return template
+        frames, columns = sampled
+
+        start = next((i for i, frame in enumerate(frames) if frame >= 0), len(frames) - 1)
+        if start or frames[0] < 0:
+            self.warnings += ["%s: dropped keys of %s before frame 0" % (action.name, bone.name)]
+            frames = [max(frames[start], 0)] + frames[start + 1:]
+            columns = [c[start:] for c in columns]
+        if frames[0] > 0:
+            # LMT tracks start at frame 0, hold the first key until the action starts
+            frames = [0] + frames
+            columns = [c[:1] + c for c in columns]
+
+        # The pose channels are relative to the rest pose, tracks to the parent. Only parentless
+        # bones get here for usages 3 and 4, their rest pose relative to the parent is the armature one
+        rest = rest_relative(bone)
+        if usage in self.ROTATION_USAGES:
+            columns = rotate_quaternions(rest.to_quaternion(), columns)
+        else:
+            columns = transform_points(rest, columns)
+
+        path = template or BonePath(
+            buffer_type=0, usage=usage, joint_type=0, unkn=0, bone_id=bone_id, weight=1.0,
+            buffer_size=0, buffer_offset=0, reference_frame=[0.0] * 4, bounds_offset=0)
+        path.bounds = None
+        if all(len(set(c)) == 1 for c in columns):
+            first = [c[0] for c in columns]
+            path.buffer = b''
+            if usage in self.ROTATION_USAGES:
+                path.reference_frame = first[1:4] + first[0:1]
+            else:
+                path.reference_frame = first + [0.0]
+        elif usage in self.ROTATION_USAGES:
+            path.buffer_type = 6
+            path.buffer = encode_quaternion_keys(frames, columns)
+        else:
+            path.buffer_type = 2
+            path.buffer = encode_vector_keys(frames, columns)
+        return path
+
+    def export_action(self, action, template = None):
+        block = AnimationBlock(
+            bone_paths_offset=0, bone_path_count=0, frame_count=int(action.frame_range[1]) + 1,
+            loop_frame=template.loop_frame if template else 0,
+            unkn=template.unkn if template else [0] * 17, events_offset=0)
+
+        block.bone_paths = []
+        exported = set()
+        for path in (template.bone_paths if template else []):
+            if path.bone_id in self.bone_map and path.usage in self.ROTATION_USAGES + self.LOCATION_USAGES:
+                path = self.bone_path(action, path.bone_id, path.usage, path)
+                exported.add((self.bone_map[path.bone_id].name, path.usage in self.ROTATION_USAGES))
+            block.bone_paths += [path]
+        for bone_id, bone in self.bone_map.items():
+            for usage in (0, 1):
+                if (bone.name, usage == 0) in exported:
+                    continue
+                exported.add((bone.name, usage == 0))
+                path = self.bone_path(action, bone_id, usage)
+                if path:
+                    block.bone_paths += [path]
+
+        block.events = getattr(template, 'events', None)
+        if block.events is None:
+            block.events = Events(events_offset=0, event_count=0, unkn=[0] * 8)
+        return block
+
 class LmtImportOperator(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
     bl_idname = "custom_import.import_lmt"
     bl_label = "Import LMT Animation"
@@ -293,9 +440,15 @@ class LmtImportOperator(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
     filename_ext = ".lmt"
     filter_glob = StringProperty(default="*.lmt", options={'HIDDEN'}, maxlen=255)
     animation_id = StringProperty(default="*", maxlen=20, name="Animation ID", description="'*' to load all animations, otherwise one number")
+    prefetch = IntProperty(default=4, min=1, max=64, name="Prefetch", description="Batches of animations decoded in worker processes ahead of the one being applied")
+    memory_budget = IntProperty(default=0, min=0, name="Memory Budget (MB)", description="Memory for decoded animations waiting to be applied and for reused track data, split evenly. 0 for no limit")
 
     def execute(self, context):
-        lmt = LMT(open(self.properties.filepath, 'rb'))
+        with open(self.properties.filepath, 'rb') as data:
+            lmt = LMT(data, stream=True)
+        return self.import_lmt(context, lmt)
+
+    def import_lmt(self, context, lmt):
         for obj in context.scene.objects:
             if (obj.type == 'ARMATURE'):
                 armature_obj = obj
@@ -307,31 +460,112 @@ class LmtImportOperator(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
 
 
         armature_obj.animation_data_create()
-        ids_to_extract = range(lmt.entry_count)
+        # File order, so workers read the file forward
+        ids = sorted((id for id in range(lmt.entry_count) if lmt.animation_offsets[id]), key=lambda id: lmt.animation_offsets[id])
         if self.animation_id != "*":
-            ids_to_extract = [int(self.animation_id)]
-        for id in ids_to_extract:
-            animation = lmt.get_animation(id)
-            if animation:
+            ids = [int(self.animation_id)]
+        budget = self.memory_budget * 1024 * 1024 // 2
+        # Where the peak can't be reset, the one reached before the import is reported next to it
+        peak_reset = reset_peak_memory()
+        peak_before = peak_memory()
+        prefetcher = AnimationPrefetcher(self.properties.filepath, ids, self.prefetch, budget)
+        track_cache = TrackCache(budget)
+        # Decoded data is released explicitly, the cycle collector only runs once at the end
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for id, key_frames in prefetcher:
                 print('\rLoading animation %03d / %03d' % (id, lmt.entry_count), end='')
-                animation = Animation(animation, armature_obj)
+                animation = Animation(None, armature_obj, key_frames)
                 for bone in armature_obj.pose.bones:
                     bone.matrix_basis = Matrix()
                 armature_obj.animation_data.action = bpy.data.actions.new("Animation %03d" % id)
-                animation.apply_animation(armature_obj)
+                animation.apply_animation(armature_obj, track_cache)
+                animation.release()
+                del animation, key_frames
+        finally:
+            prefetcher.close()
+            track_cache.clear()
+            if gc_enabled:
+                gc.enable()
+            gc.collect()
 
+        peak = peak_memory()
+        if peak is not None:
+            if peak_reset:
+                message = "Peak memory during import %.1f MB" % (peak / 1024 / 1024)
+            else:
+                message = "Peak memory of the process %.1f MB (%.1f MB before import)" % (peak / 1024 / 1024, peak_before / 1024 / 1024)
+            if prefetcher.worker_peak is not None:
+                # Worker processes run besides Blender, their memory isn't part of the peak above
+                message += ", decoding workers up to %.1f MB each" % (prefetcher.worker_peak / 1024 / 1024)
+            print('\n' + message)
+            self.report({'INFO'}, message)
         bpy.ops.object.mode_set(mode='POSE')
         return {'FINISHED'}
 
 
+class LmtExportOperator(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
+    bl_idname = "custom_export.export_lmt"
+    bl_label = "Export LMT Animation"
+    bl_options = {'REGISTER', 'PRESET'}
+
+    filename_ext = ".lmt"
+    filter_glob = StringProperty(default="*.lmt", options={'HIDDEN'}, maxlen=255)
+    base_filepath = StringProperty(name="Base LMT", subtype='FILE_PATH', description="LMT the exported animations are written into, defaults to the output file")
+    animation_id = StringProperty(default="*", maxlen=20, name="Animation ID", description="'*' to export every 'Animation NNN' action, otherwise one number")
+
+    def execute(self, context):
+        armature_obj = next((obj for obj in context.scene.objects if obj.type == 'ARMATURE'), None)
+        if armature_obj is None:
+            self.report({'ERROR'}, "No armature in the scene")
+            return {'CANCELLED'}
+
+        base_filepath = bpy.path.abspath(self.base_filepath or self.filepath)
+        if not os.path.isfile(base_filepath):
+            self.report({'ERROR'}, "Base LMT %s doesn't exist, choose the lmt to write the animations into" % base_filepath)
+            return {'CANCELLED'}
+        with open(base_filepath, 'rb') as data:
+            lmt = LMT(data)
+
+        actions = {}
+        for action in bpy.data.actions:
+            if action.name.startswith("Animation ") and action.name[10:].isdigit():
+                actions[int(action.name[10:])] = action
+        if self.animation_id != "*":
+            id = int(self.animation_id)
+            actions = {id: actions.get(id, armature_obj.animation_data and armature_obj.animation_data.action)}
+
+        exporter = AnimationExporter(armature_obj)
+        for id, action in sorted(actions.items()):
+            if action is None or id >= lmt.entry_count:
+                self.report({'WARNING'}, "Skipping animation %03d" % id)
+                continue
+            print('\rExporting animation %03d / %03d' % (id, lmt.entry_count), end='')
+            lmt.override_animation(id, exporter.export_action(action, lmt.get_animation(id)))
+        for warning in exporter.warnings:
+            self.report({'WARNING'}, warning)
+
+        with open(self.filepath, 'wb') as data:
+            data.write(lmt.serialize())
+        return {'FINISHED'}
+
+
 def menu_func_import(self, context):
     self.layout.operator(LmtImportOperator.bl_idname, text="MHW LMT (.lmt)")
 
+def menu_func_export(self, context):
+    self.layout.operator(LmtExportOperator.bl_idname, text="MHW LMT (.lmt)")
+
 def register():
     bpy.utils.register_class(LmtImportOperator)
+    bpy.utils.register_class(LmtExportOperator)
     bpy.types.INFO_MT_file_import.append(menu_func_import)
+    bpy.types.INFO_MT_file_export.append(menu_func_export)
 
 
 def unregister():
     bpy.utils.unregister_class(LmtImportOperator)
+    bpy.utils.unregister_class(LmtExportOperator)
     bpy.types.INFO_MT_file_import.remove(menu_func_import)
+    bpy.types.INFO_MT_file_export.remove(menu_func_export)
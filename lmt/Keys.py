@@ -0,0 +1,299 @@
+import sys
+import struct
+from array import array
+from io import BytesIO
+from math import sqrt
+from .Lmt import LMT, AnimationBlock
+
+# Key decoding, kept free of bpy and mathutils so it also runs in worker processes
+
+# Key values are plain tuples, (x, y, z) for vectors and (w, x, y, z) for quaternions
+def lerp3(value, bounds):
+    if (bounds is None):
+        return value
+    return tuple(x * y + z for x, y, z in zip(value, bounds.mult[0:3], bounds.add[0:3]))
+
+def lerpq(value, bounds):
+    w, x, y, z = value
+    mult = bounds.mult
+    add = bounds.add
+    return (
+        add[3] + w * mult[3],
+        add[0] + x * mult[0],
+        add[1] + y * mult[1],
+        add[2] + z * mult[2],
+    )
+
+def structread(io, format):
+    return list(struct.unpack(format, io.read(struct.calcsize(format))))
+
+class QuantizedVals:
+    def __init__(self, array, bit_per_elem = 8):
+        self.array = [int(x) for x in array]
+        self.bit_per_elem = bit_per_elem
+        self.total_bits = len(array) * bit_per_elem
+        self.elem_bits = bit_per_elem
+
+    def skipbits(self, bitcount):
+        while bitcount > 0:
+            count = min(bitcount, self.elem_bits)
+            self.elem_bits -= count
+            bitcount -= count
+            if self.elem_bits == 0:
+                self.array = self.array[1:]
+                self.elem_bits = self.bit_per_elem
+            else:
+                self.array[0] = self.array[0] >> count
+        self.total_bits -= bitcount
+
+    def loadbits(self, bitcount, scale = 0):
+        val = 0
+        bits_left = bitcount
+        current_elem = 0
+        current_bitcount = min(self.elem_bits, bits_left)
+        while bits_left > 0:
+            val = val << current_bitcount
+            val = val | (self.array[current_elem] & ((1 << current_bitcount) - 1))
+            bits_left -= current_bitcount
+            current_elem += 1
+            current_bitcount = min(self.bit_per_elem, bits_left)
+            
+
+        maxval = ((1 << bitcount) - 1)
+        if scale == 1:
+            val = val / maxval
+        elif scale == -1:
+            if val > (maxval >> 1):
+                val -= maxval
+            val = val / (maxval >> 1)
+        return val
+
+    def takebits(self, bitcount, scale = 0):
+        ret = self.loadbits(bitcount, scale)
+        self.skipbits(bitcount)
+        return ret
+
+class Key:
+    #if type == 1:
+    def baseFloatVectorKey(self, io, bounds):
+        self.value = tuple(structread(io, "fff"))
+        self.frame = 1
+    #elif type == 2 or type == 3 or type == 9:
+    def floatVectorKey(self, io, bounds):
+        self.value = tuple(structread(io, "fff"))
+        self.frame = structread(io, "I")[0]
+    #elif type == 4:
+    def shortVectorKey(self, io, bounds):
+        self.value = tuple((x / 65535) for x in structread(io, "HHH"))
+        self.frame = structread(io, "H")[0]
+        self.value = lerp3(self.value, bounds)
+
+    #elif type == 5:
+    def byteVectorKey(self, io, bounds):
+        self.value = tuple((x / 255) for x in structread(io, "BBB"))
+        self.frame = structread(io, "B")[0]
+        self.value = lerp3(self.value, bounds)
+
+    #elif type == 6:
+    def bits14QuaternionKey(self, io, bounds):
+        values = QuantizedVals(structread(io, "Q"), 64)
+        w = values.takebits(14, -1) * 2
+        z = values.takebits(14, -1) * 2
+        y = values.takebits(14, -1) * 2
+        x = values.takebits(14, -1) * 2
+        self.value = (w, x, y, z)
+        self.frame = values.takebits(8)
+
+    #elif type == 7:
+    def bits7QuaternionKey(self, io, bounds):
+        values = QuantizedVals(structread(io, "I"), 32)
+        w = values.takebits(7, 1)
+        z = values.takebits(7, 1)
+        y = values.takebits(7, 1)
+        x = values.takebits(7, 1)
+        self.frame = values.takebits(4)
+        self.value = lerpq((w, x, y, z), bounds)
+
+    def twoComponentQuaternion(self, io, bounds):
+        value = QuantizedVals(structread(io, "I"), 32)
+        if bounds is not None:
+            a = value.takebits(14, 1)
+            w = value.takebits(14, 1)
+        else:
+            w = value.takebits(14) / 0xFFF
+            a = value.takebits(14)
+            if (a > 0x1fff != 0):
+                a = -(0x1fff - a)
+            a /= 0x8ff
+        self.frame = value.takebits(4)
+        return w, a
+
+    #elif type == 11:
+    def XWQuaternionKey(self, io, bounds):
+        w, x = self.twoComponentQuaternion(io, bounds)
+        self.value = lerpq((w, x, 0, 0), bounds) if bounds is not None else (w, x, 0, 0)
+    #elif type == 12:
+    def YWQuaternionKey(self, io, bounds):
+        w, y = self.twoComponentQuaternion(io, bounds)
+        self.value = lerpq((w, 0, y, 0), bounds) if bounds is not None else (w, 0, y, 0)
+    #elif type == 13:
+    def ZWQuaternionKey(self, io, bounds):
+        w, z = self.twoComponentQuaternion(io, bounds)
+        self.value = lerpq((w, 0, 0, z), bounds) if bounds is not None else (w, 0, 0, z)
+    #elif type == 14:
+    def bits11QuaternionKey(self, io, bounds):
+        values = QuantizedVals(structread(io, "HHH"), 16)
+        x = values.takebits(11, 1)
+        y = values.takebits(11, 1)
+        z = values.takebits(11, 1)
+        w = values.takebits(11, 1)
+        self.frame = values.takebits(4)
+        self.value = lerpq((w, x, y, z), bounds)
+    #15
+    def bits9QuaternionKey(self, io, bounds):
+        values = QuantizedVals(io.read(5))
+        x = values.takebits(9, 1)
+        y = values.takebits(9, 1)
+        z = values.takebits(9, 1)
+        w = values.takebits(9, 1)
+        self.frame = values.takebits(4)
+        self.value = lerpq((w, x, y, z), bounds)
+    
+    def __init__(self, io, type, bounds):
+        [
+            None,
+            self.baseFloatVectorKey,
+            self.floatVectorKey,
+            self.floatVectorKey,
+            self.shortVectorKey,
+            self.byteVectorKey,
+            self.bits14QuaternionKey,
+            self.bits7QuaternionKey,
+            None,
+            self.floatVectorKey,
+            None,
+            self.XWQuaternionKey,
+            self.YWQuaternionKey,
+            self.ZWQuaternionKey,
+            self.bits11QuaternionKey,
+            self.bits9QuaternionKey
+        ][type](io, bounds)
+
+class BaseKey:
+    def __init__(self, ref, usage):
+        if usage == 0 or usage == 3: 
+            self.value = tuple([ref[3]] + ref[0:3])
+        else:
+            self.value = tuple(ref[0:3])
+        self.frame = 0
+
+def unit_quaternions(columns):
+    # Normalized with w >= 0, the quaternion a rotation matrix decomposes to
+    w, x, y, z = columns
+    lengths = [sqrt(bw * bw + bx * bx + by * by + bz * bz) or 1.0 for bw, bx, by, bz in zip(w, x, y, z)]
+    lengths = [-l if bw < 0 else l for bw, l in zip(w, lengths)]
+    return [array('f', (v / l for v, l in zip(c, lengths))) for c in columns]
+
+class KeyFrameList:
+    def __init__(self, bone_path):
+        # Keys are kept flat, frames holds the frame of each key and values its components
+        self.frames = array('I')
+        self.values = array('f')
+        io = BytesIO(bone_path.buffer)
+        frame = 0
+        while io.tell() < len(bone_path.buffer):
+            key = Key(io, bone_path.buffer_type, bone_path.bounds)
+            self.frames.append(frame)
+            self.values.extend(key.value)
+            frame += key.frame
+        if not self.frames:
+            self.frames.append(0)
+            self.values.extend(BaseKey(bone_path.reference_frame, bone_path.usage).value)
+        self.width = len(self.values) // len(self.frames)
+        self.bone_id = bone_path.bone_id
+        self.usage = bone_path.usage
+        self.signature = (
+            bone_path.bone_id, bone_path.usage, bone_path.buffer_type, bone_path.buffer,
+            tuple(bone_path.reference_frame),
+            bone_path.bounds and (tuple(bone_path.bounds.mult), tuple(bone_path.bounds.add))
+        )
+
+    def keys(self):
+        return zip(self.frames, zip(*[iter(self.values)] * self.width))
+
+    def columns(self):
+        return [self.values[i::self.width] for i in range(self.width)]
+
+    def points(self, columns = None):
+        # F-curve co arrays of each component, from columns computed off this track when given
+        frames = array('f', self.frames)
+        points = []
+        for index, column in enumerate(columns or self.columns()):
+            co = array('f', [0.0]) * (len(frames) * 2)
+            co[0::2] = frames
+            co[1::2] = array('f', column)
+            points += [(index, co)]
+        return points
+
+    def size(self):
+        return self.frames.itemsize * len(self.frames) + self.values.itemsize * len(self.values) + len(self.signature[3])
+
+def decode_animation(animation_block : AnimationBlock):
+    return [KeyFrameList(b) for b in animation_block.bone_paths]
+
+def decoded_size(key_frames):
+    return sum(k.size() for k in key_frames)
+
+def decode_lmt_animations(filepath, ids):
+    # Reads and decodes the given animations of an lmt file
+    with open(filepath, 'rb') as data:
+        lmt = LMT(data, stream=True)
+        return [(id, decode_animation(block)) for id, block in ((id, lmt.get_animation(id)) for id in ids) if block]
+
+def reset_peak_memory():
+    # Restarts the peak resident set size from the current one, so far only possible on Linux.
+    # Returns False when the peak is still the one of the whole process
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_memory():
+    # Peak resident set size of the process in bytes, since the last reset_peak_memory that
+    # succeeded. None when the platform doesn't tell
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in (
+                    "PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                    "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")
+            ]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    except (ImportError, AttributeError, OSError):
+        pass
+    return None
+
+def decode_worker_batch(filepath, ids):
+    # Worker entry point, the decoded animations and the peak memory of the worker so far
+    return decode_lmt_animations(filepath, ids), peak_memory()
@@ -1,7 +1,9 @@
 import json
 import struct
+from array import array
 from . import Cstruct as CS
 from io import BytesIO
+from bisect import bisect_right
 from collections import OrderedDict
 
 def readAt(data, offset, class_def):
@@ -18,6 +20,50 @@ def pad(array, amount):
     padAmount = align(len(array), amount) - len(array)
     return array + b'\0' * padAmount
 
+class ForwardReader:
+    # Reads a handle at offsets relative to base, seeking only when a read doesn't start where the
+    # previous one ended. Reading in increasing offset order then never rewinds the handle, rewinding
+    # an archive member restarts its decompression.
+    def __init__(self, handle, base):
+        self.handle = handle
+        self.base = base
+        self.position = handle.tell() - base
+
+    def read_at(self, offset, size = -1):
+        if offset != self.position:
+            self.handle.seek(self.base + offset)
+        ret = self.handle.read(size)
+        self.position = offset + len(ret)
+        return ret
+
+class StreamWindow:
+    # Read only file view starting at start, backed by one forward read of the reader.
+    # Reads past the buffered bytes extend the buffer forward, reads before start go to the reader.
+    def __init__(self, reader, start, size):
+        self.reader = reader
+        self.start = start
+        self.buffer = bytearray(reader.read_at(start, size))
+        self.position = start
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence = 0):
+        self.position = offset if whence == 0 else self.position + offset
+        return self.position
+
+    def read(self, size = -1):
+        begin = self.position - self.start
+        if size < 0 or begin < 0:
+            ret = self.reader.read_at(self.position, size)
+        else:
+            missing = begin + size - len(self.buffer)
+            if missing > 0:
+                self.buffer += self.reader.read_at(self.start + len(self.buffer), missing)
+            ret = bytes(self.buffer[begin:begin + size])
+        self.position += len(ret)
+        return ret
+
 class LMT(CS.PyCStruct):
     fields = OrderedDict([
         ("magic", "byte[4]"),
@@ -26,22 +72,53 @@ class LMT(CS.PyCStruct):
         ("unkn", "byte[8]"),
     ])
 
-    def __init__(self, data, **kwargs):
-        self.full_data = readAt(data, data.tell(), lambda d: d.read())
+    # Bytes read ahead for an animation in stream mode, up to the next animation offset
+    window_size = 0x10000
+
+    def __init__(self, data, stream = False, **kwargs):
+        # In stream mode only the header is kept, animations are read from data when requested
+        self.base = data.tell()
+        self.full_data = None if stream else readAt(data, data.tell(), lambda d: d.read())
         super().__init__(data, **kwargs)
         self.animation_offsets = []
         for i in range(self.entry_count):
             self.animation_offsets += [struct.unpack('Q', data.read(8))[0]]
+        self.reader = ForwardReader(data, self.base) if stream else None
+        self.block_starts = sorted(set(self.animation_offsets))
+
+    def load(self):
+        if self.full_data is None:
+            self.full_data = self.reader.read_at(0)
+        return self.full_data
+
+    def block_range(self, id):
+        offset = self.animation_offsets[id]
+        end = offset + self.window_size
+        next = bisect_right(self.block_starts, offset)
+        if next < len(self.block_starts):
+            end = min(end, self.block_starts[next])
+        return offset, end
     
     def get_animation(self, id):
         if self.animation_offsets[id] == 0:
             return None
-        return readAt(BytesIO(self.full_data), self.animation_offsets[id], AnimationBlock)
+        if self.full_data is not None:
+            return readAt(BytesIO(self.full_data), self.animation_offsets[id], AnimationBlock)
+        start, end = self.block_range(id)
+        return readAt(StreamWindow(self.reader, start, end - start), start, AnimationBlock)
+
+    def iter_animations(self):
+        # Animations come in file order so a stream is only ever read forward
+        for id in sorted(range(self.entry_count), key=lambda id: self.animation_offsets[id]):
+            animation = self.get_animation(id)
+            if animation:
+                yield id, animation
     
     def override_animation(self, id, animation):
-        offset = len(self.full_data)
+        offset = len(self.load())
         offset = align(offset, 16)
         self.animation_offsets[id] = offset
+        self.block_starts = sorted(set(self.animation_offsets))
         animation.update_offsets(offset)
         self.full_data = pad(self.full_data, 16) + animation.serialize()
 
@@ -49,7 +126,7 @@ class LMT(CS.PyCStruct):
         ret = super().serialize()
         for offset in self.animation_offsets:
             ret += struct.pack('Q', offset)
-        ret += self.full_data[len(ret):]
+        ret += self.load()[len(ret):]
         return ret
 
 class AnimationBlock(CS.PyCStruct):
@@ -163,83 +240,104 @@ class BonePath(CS.PyCStruct):
 
 
 class Events(CS.PyCStruct):
-    class EventParameter(CS.PyCStruct):
-        fields = OrderedDict([
-            ("offset", "uint64"),
-            ("count", "uint64"),
-            ("type", "ubyte[8]")
-        ])
-
-    class Data(CS.PyCStruct):
-        fields = OrderedDict([
-            ("values", "ubyte[20]")
-        ])
-
     fields = OrderedDict([
         ("events_offset", "uint64"),
         ("event_count", "uint64"),
         ("unkn", "int[8]")
     ])
 
+    # Events and their parameters are kept as flat columns. Both tables hold (offset, count, ubyte[8] type)
+    # entries, the type read as uint64.
+    # event_parameters and parameter_data hold the first parameter / data entry of each row
+    # plus a final end marker, data entries are 20 byte payloads packed one after the other.
+    ENTRY = struct.Struct('QQQ')
+    DATA_SIZE = 20
 
     def __init__(self, data = None, **kw):
         super().__init__(data, **kw)
+        self.event_types = array('Q')
+        self.event_parameters = array('I', [0])
+        self.parameter_types = array('Q')
+        self.parameter_events = array('I')
+        self.parameter_data = array('I', [0])
+        self.payloads = b''
+        self.index = {}
         if not data:
             return
-        
-        self.events = []
-        for i in range(self.event_count):
-            self.events += [readAt(data, self.events_offset + i * len(self.EventParameter()), self.EventParameter)]
-        
-        for event in self.events:
-            event.parameters = []
-            for i in range(event.count):
-                parameter = readAt(data, event.offset + i * len(self.EventParameter()), self.EventParameter)
-                parameter.buffer = []
-                for j in range(parameter.count):
-                    parameter.buffer += [readAt(data, parameter.offset + j * len(self.Data()), self.Data)]
-                event.parameters += [parameter]
-    
-    def update_offsets(self, offset):
-        offset += len(self)
-        self.events_offset = offset
-        self.event_count = len(self.events)
 
-        offset += len(self.EventParameter()) * self.event_count
-        offset = align(offset, 16)
+        payloads = bytearray()
+        events = self.read_entries(data, self.events_offset, self.event_count)
+        for event, (offset, count, event_type) in enumerate(events):
+            self.event_types.append(event_type)
+            for parameter_offset, data_count, parameter_type in self.read_entries(data, offset, count):
+                self.parameter_types.append(parameter_type)
+                self.parameter_events.append(event)
+                if data_count:
+                    payloads += readAt(data, parameter_offset, lambda d: d.read(data_count * self.DATA_SIZE))
+                self.parameter_data.append(len(payloads) // self.DATA_SIZE)
+            self.event_parameters.append(len(self.parameter_types))
+        self.payloads = bytes(payloads)
+        self.build_index()
 
-        for event in self.events:
-            event.count = len(event.parameters)
-            event.offset = offset
-            offset += event.count * len(self.EventParameter())
-            offset = align(offset, 16)
-        
-        for event in self.events:
-            for parameter in event.parameters:
-                parameter.count = len(parameter.buffer)
-                parameter.offset = offset
-                offset += parameter.count * len(self.Data())
-                offset = align(offset, 16)
+    def read_entries(self, data, offset, count):
+        if not count:
+            return []
+        return list(self.ENTRY.iter_unpack(readAt(data, offset, lambda d: d.read(count * self.ENTRY.size))))
 
-        return offset
+    def build_index(self):
+        self.index = {}
+        for event, event_type in enumerate(self.event_types):
+            self.index.setdefault((event_type, None), []).append(event)
+        for parameter, event in enumerate(self.parameter_events):
+            key = (self.event_types[event], self.parameter_types[parameter])
+            self.index.setdefault(key, []).append(parameter)
+
+    def find(self, event_type, parameter_type = None):
+        # Event indices for a bare event type, parameter indices when a parameter type is given
+        return self.index.get((event_type, parameter_type), [])
+
+    def parameter_count(self, event):
+        return self.event_parameters[event + 1] - self.event_parameters[event]
+
+    def data_count(self, parameter):
+        return self.parameter_data[parameter + 1] - self.parameter_data[parameter]
+
+    def payload(self, parameter):
+        return memoryview(self.payloads)[self.parameter_data[parameter] * self.DATA_SIZE:self.parameter_data[parameter + 1] * self.DATA_SIZE]
+
+    def layout(self):
+        offset = align(self.events_offset + self.ENTRY.size * self.event_count, 16)
+        parameter_offsets = []
+        for event in range(self.event_count):
+            parameter_offsets += [offset]
+            offset = align(offset + self.parameter_count(event) * self.ENTRY.size, 16)
+
+        data_offsets = []
+        for parameter in range(len(self.parameter_types)):
+            data_offsets += [offset]
+            offset = align(offset + self.data_count(parameter) * self.DATA_SIZE, 16)
+        return offset, parameter_offsets, data_offsets
+    
+    def update_offsets(self, offset):
+        self.events_offset = offset + len(self)
+        self.event_count = len(self.event_types)
+        return self.layout()[0]
 
     def serialize(self):
+        _, parameter_offsets, data_offsets = self.layout()
         ret = super().serialize()
 
-        for event in self.events:
-            ret += event.serialize()
+        for event, event_type in enumerate(self.event_types):
+            ret += self.ENTRY.pack(parameter_offsets[event], self.parameter_count(event), event_type)
         ret = pad(ret, 16)
 
+        for event in range(self.event_count):
+            for parameter in range(self.event_parameters[event], self.event_parameters[event + 1]):
+                ret += self.ENTRY.pack(data_offsets[parameter], self.data_count(parameter), self.parameter_types[parameter])
+            ret = pad(ret, 16)
 
-        for event in self.events:
-            for parameter in event.parameters:
-                ret += parameter.serialize()
+        for parameter in range(len(self.parameter_types)):
+            ret += self.payload(parameter)
             ret = pad(ret, 16)
-        
-        for event in self.events:
-            for parameter in event.parameters:
-                for data in parameter.buffer:
-                    ret += data.serialize()
-                ret = pad(ret, 16)
 
-        return ret
\ No newline at end of file
+        return ret
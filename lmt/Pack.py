@@ -0,0 +1,261 @@
+import mmap
+import struct
+import hashlib
+from . import Cstruct as CS
+from .Lmt import LMT, AnimationBlock, BonePath, Events, readAt, align
+from io import BytesIO
+from collections import OrderedDict
+
+# Library pack layout:
+#   PackHeader
+#   blobs (bone path buffers, bounds, event tables and lmt headers), each stored once, 16 aligned
+#   per animation: PackAnimation, AnimationBlock header, PackPath + BonePath for every path
+#   file names, per file uint64 offsets to its PackAnimation records (0 when empty)
+#   PackFile table, PackBlob table
+#   PackEventType table, every (event type, parameter type) pair of each event table blob, sorted
+# Tables have fixed size entries so any file, animation or blob is found without a scan.
+
+class PackHeader(CS.PyCStruct):
+    fields = OrderedDict([
+        ("magic", "byte[4]"),
+        ("version", "int"),
+        ("file_count", "int"),
+        ("blob_count", "int"),
+        ("files_offset", "uint64"),
+        ("blobs_offset", "uint64"),
+        ("event_types_offset", "uint64"),
+        ("event_type_count", "int"),
+        ("unkn", "int"),
+    ])
+
+class PackFile(CS.PyCStruct):
+    fields = OrderedDict([
+        ("name_offset", "uint64"),
+        ("name_size", "int"),
+        ("entry_count", "int"),
+        ("header_blob", "int"),
+        ("unkn", "int"),
+        ("animations_offset", "uint64"),
+    ])
+
+class PackBlob(CS.PyCStruct):
+    fields = OrderedDict([
+        ("offset", "uint64"),
+        ("size", "uint64"),
+    ])
+
+class PackAnimation(CS.PyCStruct):
+    fields = OrderedDict([
+        ("events_blob", "int"),
+        ("path_count", "int"),
+        ("paths_offset", "uint64"),
+    ])
+
+class PackPath(CS.PyCStruct):
+    fields = OrderedDict([
+        ("buffer_blob", "int"),
+        ("bounds_blob", "int"),
+    ])
+
+class PackEventType(CS.PyCStruct):
+    # has_parameter is 0 for the entry of the bare event type
+    fields = OrderedDict([
+        ("event_type", "uint64"),
+        ("parameter_type", "uint64"),
+        ("has_parameter", "int"),
+        ("events_blob", "int"),
+    ])
+
+MAGIC = list(b'LMTP')
+VERSION = 2
+# PackEventType entries, read in bulk
+EVENT_TYPE = struct.Struct('QQii')
+
+class PackWriter:
+    def __init__(self, out):
+        self.out = out
+        self.base = out.tell()
+        self.blobs = {}
+        self.blob_table = []
+        self.files = []
+        self.event_types = set()
+        out.write(b'\0' * len(PackHeader()))
+
+    def tell(self):
+        return self.out.tell() - self.base
+
+    def write(self, data, alignment = 1):
+        offset = align(self.tell(), alignment)
+        self.out.write(b'\0' * (offset - self.tell()) + data)
+        return offset
+
+    def blob(self, data):
+        if not data:
+            return -1
+        key = hashlib.sha1(data).digest()
+        if key not in self.blobs:
+            self.blobs[key] = len(self.blob_table)
+            self.blob_table += [(self.write(data, 16), len(data))]
+        return self.blobs[key]
+
+    def add_animation(self, block):
+        events = -1
+        if block.events_offset:
+            block.events.update_offsets(0)
+            events = self.blob(block.events.serialize())
+            for event_type, parameter_type in block.events.index:
+                self.event_types.add((event_type, parameter_type is not None, parameter_type or 0, events))
+        paths = [
+            PackPath(
+                buffer_blob=self.blob(path.buffer),
+                bounds_blob=self.blob(path.bounds.serialize()) if path.bounds else -1
+            ).serialize() + path.serialize()
+            for path in block.bone_paths
+        ]
+        block_data = block.serialize_block()
+        offset = align(self.tell(), 16)
+        record = PackAnimation(
+            events_blob=events, path_count=len(paths),
+            paths_offset=offset + len(PackAnimation()) + len(block_data)
+        )
+        return self.write(record.serialize() + block_data + b''.join(paths), 16)
+
+    def add(self, name, lmt):
+        offsets = [0] * lmt.entry_count
+        for id, block in lmt.iter_animations():
+            offsets[id] = self.add_animation(block)
+        self.files += [(name, self.blob(CS.PyCStruct.serialize(lmt)), offsets)]
+
+    def finish(self):
+        entries = b''
+        for name, header, offsets in self.files:
+            name = name.encode('utf-8')
+            name_offset = self.write(name)
+            animations_offset = self.write(struct.pack('%dQ' % len(offsets), *offsets), 8)
+            entries += PackFile(
+                name_offset=name_offset, name_size=len(name), entry_count=len(offsets),
+                header_blob=header, unkn=0, animations_offset=animations_offset
+            ).serialize()
+        files_offset = self.write(entries, 16)
+        blobs_offset = self.write(b''.join(
+            PackBlob(offset=offset, size=size).serialize() for offset, size in self.blob_table
+        ), 16)
+        event_types_offset = self.write(b''.join(
+            PackEventType(
+                event_type=event_type, parameter_type=parameter_type,
+                has_parameter=int(has_parameter), events_blob=events
+            ).serialize()
+            for event_type, has_parameter, parameter_type, events in sorted(self.event_types)
+        ), 16)
+
+        header = PackHeader(
+            magic=MAGIC, version=VERSION, file_count=len(self.files), blob_count=len(self.blob_table),
+            files_offset=files_offset, blobs_offset=blobs_offset,
+            event_types_offset=event_types_offset, event_type_count=len(self.event_types), unkn=0
+        )
+        end = self.out.tell()
+        self.out.seek(self.base)
+        self.out.write(header.serialize())
+        self.out.seek(end)
+
+class Pack:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = readAt(self.data, 0, PackHeader)
+        if self.header.magic != MAGIC or self.header.version != VERSION:
+            self.close()
+            raise ValueError("Not a LMT pack (version %d)" % VERSION)
+        self.names = {}
+        for index in range(self.header.file_count):
+            entry = self.file_entry(index)
+            name = self.data[entry.name_offset:entry.name_offset + entry.name_size].decode('utf-8')
+            self.names[name] = index
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def file_entry(self, file):
+        if isinstance(file, str):
+            file = self.names[file]
+        return readAt(self.data, self.header.files_offset + file * len(PackFile()), PackFile)
+
+    def blob(self, index):
+        offset, size = struct.unpack_from('QQ', self.data, self.header.blobs_offset + index * len(PackBlob()))
+        return self.data[offset:offset + size]
+
+    def animation_offset(self, file, id):
+        entry = self.file_entry(file)
+        if id >= entry.entry_count:
+            return 0
+        return struct.unpack_from('Q', self.data, entry.animations_offset + id * 8)[0]
+
+    def index(self):
+        for name, file in self.names.items():
+            entry = self.file_entry(file)
+            offsets = struct.unpack_from('%dQ' % entry.entry_count, self.data, entry.animations_offset)
+            for id, offset in enumerate(offsets):
+                if offset:
+                    yield name, id, offset
+
+    def read_animation(self, offset):
+        record = readAt(self.data, offset, PackAnimation)
+        block = readAt(self.data, offset + len(record), AnimationBlock().marshall)
+
+        block.bone_paths = []
+        path_size = len(PackPath()) + len(BonePath())
+        for i in range(record.path_count):
+            path_offset = record.paths_offset + i * path_size
+            pack_path = readAt(self.data, path_offset, PackPath)
+            path = readAt(self.data, path_offset + len(pack_path), BonePath().marshall)
+            path.buffer = self.blob(pack_path.buffer_blob) if pack_path.buffer_blob >= 0 else b''
+            path.bounds = None
+            if pack_path.bounds_blob >= 0:
+                path.bounds = BonePath.Bounds(BytesIO(self.blob(pack_path.bounds_blob)))
+            block.bone_paths += [path]
+
+        if record.events_blob >= 0:
+            block.events = Events(BytesIO(self.blob(record.events_blob)))
+        else:
+            block.events = Events(events_offset=0, event_count=0, unkn=[0] * 8)
+        return block
+
+    def get_animation(self, file, id):
+        offset = self.animation_offset(file, id)
+        if not offset:
+            return None
+        return self.read_animation(offset)
+
+    def get_lmt(self, file):
+        entry = self.file_entry(file)
+        header = self.blob(entry.header_blob) + b'\0' * 8 * entry.entry_count
+        lmt = LMT(BytesIO(header))
+        offsets = struct.unpack_from('%dQ' % entry.entry_count, self.data, entry.animations_offset)
+        for id, offset in enumerate(offsets):
+            if offset:
+                lmt.override_animation(id, self.read_animation(offset))
+        return lmt
+
+    def event_blobs(self, event_type, parameter_type = None):
+        # Event table blobs holding the type, from the type table alone
+        table = self.data[self.header.event_types_offset:self.header.event_types_offset + self.header.event_type_count * EVENT_TYPE.size]
+        return {
+            events_blob for type, parameter, has_parameter, events_blob in EVENT_TYPE.iter_unpack(table)
+            if type == event_type and (parameter == parameter_type if has_parameter else parameter_type is None)
+        }
+
+    def find_events(self, event_type, parameter_type = None):
+        # Only the type table and the events_blob of each animation record are read
+        blobs = self.event_blobs(event_type, parameter_type)
+        if not blobs:
+            return
+        for name, id, offset in self.index():
+            if readAt(self.data, offset, PackAnimation).events_blob in blobs:
+                yield name, id